@@ -1,47 +1,71 @@
+import asyncio
+import hashlib
+import logging
 import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
 from dotenv import load_dotenv
 load_dotenv()  # loads backend/.env into environment
-import re
 from io import BytesIO
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import BotoCoreError, ClientError
 from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from PIL import Image
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+logger = logging.getLogger(__name__)
 
 
 # -------------------------
 # App + CORS
 # -------------------------
-app = FastAPI(title="Supplier Price Watch API")
-from fastapi import HTTPException
-import os
-import boto3
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: Textract client, thread pools, image codecs; teardown: thread pools
+    _init_textract_client(app)
+    _init_executors(app)
+    _warm_image_codecs(app)
+    yield
+    _shutdown_executors(app)
 
-from io import BytesIO
-from fastapi import HTTPException
-from botocore.exceptions import BotoCoreError, ClientError
-from PIL import Image
 
-@app.get("/health/textract")
-def health_textract():
-    try:
-        textract = _textract_client()
+app = FastAPI(title="Supplier Price Watch API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
-        # 1x1 image so Textract can be called safely
-        img = Image.new("RGB", (1, 1), (255, 255, 255))
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        test_bytes = buf.getvalue()
 
-        textract.detect_document_text(Document={"Bytes": test_bytes})
-        return {"status": "ok", "textract": "ok"}
+class _RejectOversizeBody:
+    """
+    Starlette spools the whole multipart body before any handler (or dependency)
+    runs, so an oversize upload is refused here from its Content-Length, unread.
+    Plain ASGI (no BaseHTTPMiddleware task group / stream wrapper per request).
+    Chunked uploads (no Content-Length) fall back to the check in _upload_spool.
+    """
 
-    except (BotoCoreError, ClientError) as e:
-        raise HTTPException(status_code=502, detail=f"Textract check failed: {str(e)}")
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            for name, value in scope["headers"]:
+                if name == b"content-length":
+                    if value.isdigit() and int(value) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+                        err = _too_large(MAX_UPLOAD_BYTES)
+                        response = ORJSONResponse(status_code=err.status_code, content={"detail": err.detail})
+                        await response(scope, receive, send)
+                        return
+                    break
+        await self.app(scope, receive, send)
+
+
+# Added before CORS so CORS wraps it and the 400 still gets CORS headers
+app.add_middleware(_RejectOversizeBody)
 
 # For dev: allow all. In production lock this down to your Vercel domain.
 app.add_middleware(
@@ -56,9 +80,37 @@ app.add_middleware(
 # Constants
 # -------------------------
 MAX_SYNC_BYTES = 5 * 1024 * 1024  # Textract sync APIs: keep it small & safe
+# Images above MAX_SYNC_BYTES are still accepted up to this size: PIL shrinks
+# them and MAX_SYNC_BYTES is applied to the re-encoded JPEG instead.
+MAX_UPLOAD_BYTES = 20 * 1024 * 1024
+# Slack for multipart boundaries/part headers when judging Content-Length
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+# Long-edge cap (px) for images we re-encode (HEIC, non-JPEG/PNG, and JPEG/PNG
+# over MAX_SYNC_BYTES); ~2400 px keeps OCR accuracy while cutting bytes sent
+# to Textract. JPEG/PNG within MAX_SYNC_BYTES are sent as-is, never resized.
+# Set MAX_OCR_EDGE_PX=0 to disable.
+MAX_OCR_EDGE_PX = int(os.getenv("MAX_OCR_EDGE_PX", "2400"))
+
+# JPEG settings when we have to re-encode for Textract.
+# 4:4:4 (no chroma subsampling) at q95 keeps small text sharp; optimize=True
+# re-runs Huffman optimisation for almost no size win on one-shot uploads.
+TEXTRACT_JPEG_KWARGS: Dict[str, Any] = {
+    "quality": 95,
+    "subsampling": 0,
+    "progressive": False,
+    "optimize": False,
+}
 
 SUPPORTED_EXTS = {".pdf", ".png", ".jpg", ".jpeg", ".heic", ".heif"}
 
+# Exts that unlock the JPEG/PNG pass-through; only _sniff_ext may assign them
+PASSTHROUGH_IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+
+# PIL modes Textract reads fine as-is; JPEG/PNG in any other mode (CMYK, P,
+# LA, RGBA, I;16, ...) still go through PIL and come out as RGB JPEG
+PASSTHROUGH_IMAGE_MODES = {"RGB", "L"}
+
 # Content-types we consider valid
 SUPPORTED_CONTENT_TYPES = {
     "application/pdf",
@@ -71,6 +123,24 @@ SUPPORTED_CONTENT_TYPES = {
     "application/octet-stream",
 }
 
+# ISO-BMFF brands (bytes 4-12) that mark a HEIC/HEIF file
+HEIF_BRANDS = {b"ftypheic", b"ftypheix", b"ftypmif1", b"ftypmsf1"}
+
+AWS_REGION = os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION")
+
+# Textract thread pool size and HTTPS connection pool size (kept equal)
+TEXTRACT_MAX_CONNECTIONS = 32
+
+# ClientError codes meaning "this document is unreadable" -> 400, not 502
+TEXTRACT_BAD_DOCUMENT_ERRORS = {
+    "UnsupportedDocumentException",
+    "BadDocumentException",
+    "InvalidParameterException",
+}
+
+# Textract response cache entries (LRU); 0 disables
+TEXTRACT_CACHE_SIZE = int(os.getenv("TEXTRACT_CACHE_SIZE", "128"))
+
 
 # -------------------------
 # Health
@@ -80,21 +150,39 @@ def health():
     return {"status": "ok"}
 
 
+@app.get("/health/textract")
+def health_textract():
+    try:
+        textract = app.state.textract
+
+        # 1x1 image so Textract can be called safely
+        img = Image.new("RGB", (1, 1), (255, 255, 255))
+        buf = BytesIO()
+        img.save(buf, format="PNG")
+        test_bytes = buf.getvalue()
+
+        textract.detect_document_text(Document={"Bytes": test_bytes})
+        return {"status": "ok", "textract": "ok"}
+
+    except (BotoCoreError, ClientError) as e:
+        raise HTTPException(status_code=502, detail=f"Textract check failed: {str(e)}")
+
+
 # -------------------------
 # Main endpoint (keep both spellings)
 # -------------------------
 @app.post("/analyse")
-async def analyse(file: UploadFile = File(...)):
-    return await _analyse_impl(file)
+async def analyse(file: UploadFile = File(...), debug: bool = False):
+    return await _analyse_impl(file, debug)
 
 
 @app.post("/analyze")
-async def analyze(file: UploadFile = File(...)):
+async def analyze(file: UploadFile = File(...), debug: bool = False):
     # Alias so you don't break older frontend calls
-    return await _analyse_impl(file)
+    return await _analyse_impl(file, debug)
 
 
-async def _analyse_impl(file: UploadFile) -> Dict[str, Any]:
+async def _analyse_impl(file: UploadFile, debug: bool = False) -> Dict[str, Any]:
     filename = (file.filename or "").strip()
     if not filename:
         raise HTTPException(status_code=400, detail="Missing filename.")
@@ -102,95 +190,314 @@ async def _analyse_impl(file: UploadFile) -> Dict[str, Any]:
     ext = _ext_lower(filename)
     content_type = (file.content_type or "").strip().lower()
 
-    # Allow either extension or content-type to decide support
-    if ext and ext not in SUPPORTED_EXTS:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported file extension '{ext}'. Supported: PDF, PNG, JPG/JPEG, HEIC/HEIF.",
-        )
-
-    if content_type and content_type not in SUPPORTED_CONTENT_TYPES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unsupported content-type '{content_type}'. Supported: PDF or image files.",
-        )
-
-    raw = await file.read()
-    if not raw:
+    spool, size = _upload_spool(file)
+    if not size:
         raise HTTPException(status_code=400, detail="Empty file.")
-    if len(raw) > MAX_SYNC_BYTES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"File too large for realtime extraction (max {MAX_SYNC_BYTES // (1024*1024)} MB).",
-        )
 
-    # Decide ext if missing / weird
-    if not ext:
-        ext = _guess_ext_from_content_type(content_type)
+    # Magic bytes win over the (user-controlled) name / content-type: a real
+    # PDF/JPEG/PNG/HEIC is accepted whatever it's called (.jfif, x-pdf, ...).
+    # A file that doesn't sniff as JPEG/PNG never keeps a .jpg/.png ext, so it
+    # can't take the pass-through: PIL converts it or rejects it with a 400.
+    # Content-type is folded into ext here and not used past this point.
+    sniffed = _sniff_ext(spool)
+    if sniffed:
+        ext = sniffed
+    else:
+        # Unrecognised bytes: allow either extension or content-type to decide support
+        if ext and ext not in SUPPORTED_EXTS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported file extension '{ext}'. Supported: PDF, PNG, JPG/JPEG, HEIC/HEIF.",
+            )
+
+        if content_type and content_type not in SUPPORTED_CONTENT_TYPES:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported content-type '{content_type}'. Supported: PDF or image files.",
+            )
 
-    # Convert images -> JPEG bytes, PDF stays PDF
+        # Decide ext if missing / weird
+        if not ext:
+            ext = _guess_ext_from_content_type(content_type)
+        if ext in PASSTHROUGH_IMAGE_EXTS:
+            ext = ""
+
+    # PDFs go to Textract as-is, so the sync limit applies to the upload itself
+    if ext == ".pdf" and size > MAX_SYNC_BYTES:
+        raise _too_large(MAX_SYNC_BYTES)
+
+    # PDF/JPEG/PNG that Textract takes as-is are just read (and hashed for the
+    # cache) on the Textract pool. Only real conversions - HEIC, other formats,
+    # oversize JPEG/PNG - go to the PIL pool, so they can't hold up the rest.
+    loop = asyncio.get_running_loop()
+    normalized_type = _passthrough_type(spool, ext, size)
     try:
-        document_bytes, normalized_type = _normalize_for_textract(raw, ext, content_type)
+        if normalized_type:
+            document_bytes, digest = await loop.run_in_executor(
+                app.state.textract_executor, _read_document, spool
+            )
+        else:
+            document_bytes, normalized_type, digest = await loop.run_in_executor(
+                app.state.image_executor, _convert_document, spool, ext
+            )
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Could not process file: {e}")
 
-    # Call AWS Textract AnalyzeExpense
-    try:
-        textract = _textract_client()
-        resp = textract.analyze_expense(Document={"Bytes": document_bytes})
-    except (BotoCoreError, ClientError) as e:
-        raise HTTPException(status_code=502, detail=f"AWS Textract error: {str(e)}")
+    # Call AWS Textract AnalyzeExpense (blocking network call -> thread),
+    # unless we've already analysed these exact bytes
+    resp = _cache_get(digest)
+    if resp is not None:
+        # Server-side only: the cache is shared by every caller, so telling a
+        # client "hit" would reveal that someone else uploaded the same file
+        logger.info("Textract cache hit (%s)", digest.hex()[:12])
+    else:
+        try:
+            resp = await loop.run_in_executor(
+                app.state.textract_executor, _analyze_expense, app.state.textract, document_bytes
+            )
+        except ClientError as e:
+            # Textract rejecting the document itself is the upload's fault, not ours
+            if e.response.get("Error", {}).get("Code") in TEXTRACT_BAD_DOCUMENT_ERRORS:
+                raise HTTPException(status_code=400, detail=f"Textract could not read this file: {str(e)}")
+            raise HTTPException(status_code=502, detail=f"AWS Textract error: {str(e)}")
+        except BotoCoreError as e:
+            raise HTTPException(status_code=502, detail=f"AWS Textract error: {str(e)}")
+        _cache_put(digest, resp)
 
     # Parse vendor/total/date/items
     vendor, total, currency, date = _parse_summary_fields(resp)
-    items = _parse_line_items(resp)
+    items = _parse_line_items(resp, with_raw_fields=debug)
 
-    return {
+    out: Dict[str, Any] = {
         "filename": filename,
-        "input_type": normalized_type,  # "pdf" or "image/jpeg"
+        "input_type": normalized_type,  # "pdf", "image/jpeg" or "image/png"
         "vendor": vendor,
         "total": total,
         "currency": currency,
         "date": date,
         "items": items,
         "items_count": len(items),
-        "debug": {
+    }
+    # ?debug=1 adds raw Textract fields per item + request details
+    if debug:
+        out["debug"] = {
             "content_type": content_type,
             "ext": ext,
-            "bytes": len(raw),
+            "bytes": size,
             "has_expense_documents": bool(resp.get("ExpenseDocuments")),
-        },
-    }
+        }
+    return out
+
+
+# -------------------------
+# Thread pools
+# PIL work is CPU-bound -> one thread per core. Textract calls just wait on the
+# network -> one thread per pooled connection. Kept apart so a burst of HEIC
+# conversions can't hold up Textract calls (and vice versa).
+# Created per app lifespan (like the Textract client), so a restarted app
+# never submits to pools a previous shutdown already closed.
+# -------------------------
+def _init_executors(app: FastAPI):
+    app.state.image_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="image")
+    app.state.textract_executor = ThreadPoolExecutor(
+        max_workers=TEXTRACT_MAX_CONNECTIONS, thread_name_prefix="textract"
+    )
+
+
+def _shutdown_executors(app: FastAPI):
+    app.state.image_executor.shutdown(wait=False, cancel_futures=True)
+    app.state.textract_executor.shutdown(wait=False, cancel_futures=True)
+
+
+# -------------------------
+# Upload reading
+# -------------------------
+def _upload_spool(file: UploadFile) -> Tuple[BinaryIO, int]:
+    """
+    Starlette has already spooled the body (memory, then disk past 1 MB), so we
+    size it with a seek and hand the spool itself to PIL / Textract - no copy.
+    Returns: spool (rewound), size in bytes
+    """
+    spool = file.file
+    spool.seek(0, os.SEEK_END)
+    size = spool.tell()
+    spool.seek(0)
+    if size > MAX_UPLOAD_BYTES:
+        raise _too_large(MAX_UPLOAD_BYTES)
+    return spool, size
+
+
+def _too_large(limit: int) -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"File too large for realtime extraction (max {limit // (1024*1024)} MB).",
+    )
 
 
 # -------------------------
 # AWS client
+# Built once at startup so the HTTPS pool to Textract stays warm
+# -------------------------
+TEXTRACT_CLIENT_CONFIG = Config(
+    max_pool_connections=TEXTRACT_MAX_CONNECTIONS,
+    retries={"mode": "adaptive", "total_max_attempts": 3},
+)
+
+
+def _init_textract_client(app: FastAPI):
+    # Fail at boot rather than on the first upload
+    if not AWS_REGION:
+        raise RuntimeError("AWS_REGION is not set in environment.")
+    app.state.textract = boto3.client("textract", region_name=AWS_REGION, config=TEXTRACT_CLIENT_CONFIG)
+
+
+# -------------------------
+# Textract response cache
+# SHA-256 of the document bytes -> compacted AnalyzeExpense response (LRU)
+# Re-uploads of the same invoice skip the Textract round-trip (and its cost).
+# Entries hold only the Type/Value text the parsers read (no Blocks, no
+# geometry), so each is a few KB of strings.
+# Only touched from the event loop thread, so no lock needed.
 # -------------------------
-def _textract_client():
-    region = os.getenv("AWS_REGION") or os.getenv("AWS_DEFAULT_REGION")
-    if not region:
-        raise HTTPException(status_code=500, detail="AWS_REGION is not set in environment.")
-    return boto3.client("textract", region_name=region)
+_textract_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+
+
+def _analyze_expense(textract: Any, document_bytes: bytes) -> Dict[str, Any]:
+    resp = textract.analyze_expense(Document={"Bytes": document_bytes})
+    return _compact_response(resp)
+
+
+def _compact_response(resp: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Same shape as an AnalyzeExpense response, cut down to the first document's
+    SummaryFields / LineItemGroups with each field reduced to Type/Value text.
+    """
+    docs = resp.get("ExpenseDocuments") or []
+    if not docs:
+        return {"ExpenseDocuments": []}
+
+    doc0 = docs[0]
+    groups = [
+        {
+            "LineItems": [
+                {"LineItemExpenseFields": [_compact_field(f) for f in li.get("LineItemExpenseFields") or []]}
+                for li in g.get("LineItems") or []
+            ]
+        }
+        for g in doc0.get("LineItemGroups") or []
+    ]
+    return {
+        "ExpenseDocuments": [
+            {
+                "SummaryFields": [_compact_field(f) for f in doc0.get("SummaryFields") or []],
+                "LineItemGroups": groups,
+            }
+        ]
+    }
+
+
+def _compact_field(field: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "Type": {"Text": (field.get("Type") or {}).get("Text")},
+        "ValueDetection": {"Text": (field.get("ValueDetection") or {}).get("Text")},
+    }
+
+
+def _cache_key(document_bytes: bytes) -> Optional[bytes]:
+    # Worker threads only (hashing 5 MB isn't free); no hash at all with the cache off
+    if TEXTRACT_CACHE_SIZE <= 0:
+        return None
+    return hashlib.sha256(document_bytes).digest()
+
+
+def _cache_get(digest: Optional[bytes]) -> Optional[Dict[str, Any]]:
+    if digest is None:
+        return None
+    resp = _textract_cache.get(digest)
+    if resp is not None:
+        _textract_cache.move_to_end(digest)
+    return resp
+
+
+def _cache_put(digest: Optional[bytes], resp: Dict[str, Any]) -> None:
+    if digest is None:
+        return
+    _textract_cache[digest] = resp
+    _textract_cache.move_to_end(digest)
+    while len(_textract_cache) > TEXTRACT_CACHE_SIZE:
+        _textract_cache.popitem(last=False)
 
 
 # -------------------------
 # Normalization
-# HEIC/PNG/JPG -> JPEG bytes
-# PDF stays PDF
+# HEIC/other images -> JPEG bytes
+# PDF/PNG/JPG stay as-is (Textract accepts them natively)
 # -------------------------
-def _normalize_for_textract(raw: bytes, ext: str, content_type: str) -> Tuple[bytes, str]:
-    # Treat PDF as-is
-    if ext == ".pdf" or content_type == "application/pdf":
-        return raw, "pdf"
+def _warm_image_codecs(app: FastAPI):
+    # Pay PIL plugin loading + pillow-heif import at boot, not on the first upload
+    Image.init()
+    try:
+        import pillow_heif  # type: ignore
+        pillow_heif.register_heif_opener()
+        app.state.heif_available = True
+    except Exception:
+        app.state.heif_available = False
 
-    # HEIC/HEIF requires extra decoder
-    if ext in {".heic", ".heif"} or content_type in {"image/heic", "image/heif"}:
-        try:
-            import pillow_heif  # type: ignore
-            pillow_heif.register_heif_opener()
-        except Exception:
+
+def _passthrough_type(spool: BinaryIO, ext: str, size: int) -> Optional[str]:
+    """
+    ext is already resolved by the caller (magic bytes first); it is only
+    .jpg/.png when the bytes really are JPEG/PNG.
+    Returns: normalized type if Textract gets the upload as-is, None if PIL must convert it
+    """
+    # Treat PDF as-is (size already checked against MAX_SYNC_BYTES)
+    if ext == ".pdf":
+        return "pdf"
+    # JPEG/PNG go through untouched: re-encoding costs CPU and hurts Textract accuracy.
+    # Too big for Textract or not RGB/grey -> None, so PIL shrinks / converts them.
+    if size <= MAX_SYNC_BYTES and ext in {".jpg", ".png"} and _image_mode(spool) in PASSTHROUGH_IMAGE_MODES:
+        return "image/jpeg" if ext == ".jpg" else "image/png"
+    return None
+
+
+def _image_mode(spool: BinaryIO) -> Optional[str]:
+    # Image.open is lazy: it parses the header only, nothing is decoded
+    try:
+        with Image.open(spool) as img:
+            return img.mode
+    except Exception:
+        return None  # unreadable -> PIL path, which turns it into a 400
+    finally:
+        spool.seek(0)
+
+
+def _read_document(spool: BinaryIO) -> Tuple[bytes, Optional[bytes]]:
+    """
+    Runs on the Textract pool for pass-through uploads.
+    Returns: document bytes, cache key
+    """
+    document_bytes = spool.read()
+    return document_bytes, _cache_key(document_bytes)
+
+
+def _convert_document(spool: BinaryIO, ext: str) -> Tuple[bytes, str, Optional[bytes]]:
+    """
+    Runs on the image pool.
+    Returns: JPEG bytes, normalized type, cache key
+    """
+    document_bytes, normalized_type = _normalize_for_textract(spool, ext)
+    return document_bytes, normalized_type, _cache_key(document_bytes)
+
+
+def _normalize_for_textract(spool: BinaryIO, ext: str) -> Tuple[bytes, str]:
+    # Only called for uploads _passthrough_type rejected: everything here is
+    # decoded by PIL and re-encoded as JPEG.
+
+    # HEIC/HEIF requires extra decoder (registered at startup)
+    if ext in {".heic", ".heif"}:
+        if not app.state.heif_available:
             raise HTTPException(
                 status_code=400,
                 detail=(
@@ -201,22 +508,51 @@ def _normalize_for_textract(raw: bytes, ext: str, content_type: str) -> Tuple[by
 
     # Convert any image -> JPEG for Textract
     try:
-        img = Image.open(BytesIO(raw))
+        img = Image.open(spool)
     except Exception as e:
         raise HTTPException(
             status_code=400,
             detail=f"Could not open uploaded image. If this is a screenshot, re-save as PNG/JPG. Error: {e}",
         )
 
+    # JPEG: let libjpeg decode at a reduced scale (never below the cap) instead
+    # of full resolution; no-op for other formats
+    if MAX_OCR_EDGE_PX and max(img.size) > MAX_OCR_EDGE_PX:
+        img.draft("RGB", (MAX_OCR_EDGE_PX, MAX_OCR_EDGE_PX))
+
     # Ensure RGB (Textract likes JPEG RGB)
     if img.mode not in ("RGB",):
         img = img.convert("RGB")
 
+    # Downsample big photos (in place, keeps aspect ratio)
+    if MAX_OCR_EDGE_PX and max(img.size) > MAX_OCR_EDGE_PX:
+        img.thumbnail((MAX_OCR_EDGE_PX, MAX_OCR_EDGE_PX), Image.Resampling.LANCZOS)
+
     out = BytesIO()
-    img.save(out, format="JPEG", quality=90, optimize=True)
+    img.save(out, format="JPEG", **TEXTRACT_JPEG_KWARGS)
+    if out.tell() > MAX_SYNC_BYTES:
+        raise _too_large(MAX_SYNC_BYTES)
     return out.getvalue(), "image/jpeg"
 
 
+def _sniff_ext(spool: BinaryIO) -> Optional[str]:
+    """
+    Detects the real file type from its first bytes (spool is rewound).
+    Returns: ".pdf" / ".jpg" / ".png" / ".heic", or None if unrecognised
+    """
+    head = spool.read(12)
+    spool.seek(0)
+    if head[:4] == b"%PDF":
+        return ".pdf"
+    if head[:3] == b"\xff\xd8\xff":
+        return ".jpg"
+    if head[:8] == b"\x89PNG\r\n\x1a\n":
+        return ".png"
+    if head[4:12] in HEIF_BRANDS:
+        return ".heic"
+    return None
+
+
 def _guess_ext_from_content_type(content_type: str) -> str:
     if content_type == "application/pdf":
         return ".pdf"
@@ -232,13 +568,25 @@ def _guess_ext_from_content_type(content_type: str) -> str:
 
 def _ext_lower(name: str) -> str:
     name = name.lower()
-    m = re.search(r"(\.[a-z0-9]+)$", name)
-    return m.group(1) if m else ""
+    i = name.rfind(".")
+    tail = name[i + 1:]
+    return name[i:] if i >= 0 and tail.isascii() and tail.isalnum() else ""
 
 
 # -------------------------
 # Parsing helpers (AnalyzeExpense response)
 # -------------------------
+# Field types to try, in priority order
+VENDOR_KEYS = ("VENDOR_NAME", "SUPPLIER_NAME", "MERCHANT_NAME")
+TOTAL_KEYS = ("TOTAL", "AMOUNT_DUE", "INVOICE_RECEIPT_TOTAL")
+DATE_KEYS = ("INVOICE_RECEIPT_DATE", "INVOICE_RECEIPT_RECEIPT_DATE", "DATE")
+
+DESC_KEYS = ("ITEM", "DESCRIPTION", "PRODUCT_CODE", "NAME")
+QTY_KEYS = ("QUANTITY",)
+UNIT_PRICE_KEYS = ("UNIT_PRICE", "PRICE")
+AMOUNT_KEYS = ("AMOUNT", "LINE_TOTAL", "TOTAL_PRICE")
+
+
 def _parse_summary_fields(resp: Dict[str, Any]) -> Tuple[Optional[str], Optional[float], Optional[str], Optional[str]]:
     """
     Returns: vendor, total, currency, date
@@ -248,11 +596,11 @@ def _parse_summary_fields(resp: Dict[str, Any]) -> Tuple[Optional[str], Optional
         return None, None, None, None
 
     doc0 = docs[0]
-    summary_fields = doc0.get("SummaryFields") or []
+    summary = _index_fields(doc0.get("SummaryFields") or [])
 
-    vendor = _pick_summary(summary_fields, ["VENDOR_NAME", "SUPPLIER_NAME", "MERCHANT_NAME"])
-    total_str = _pick_summary(summary_fields, ["TOTAL", "AMOUNT_DUE", "INVOICE_RECEIPT_TOTAL"])
-    date = _pick_summary(summary_fields, ["INVOICE_RECEIPT_DATE", "INVOICE_RECEIPT_RECEIPT_DATE", "DATE"])
+    vendor = _pick_vendor(summary)
+    total_str = _pick_total(summary)
+    date = _pick_date(summary)
 
     total = _to_float(total_str)
     currency = _guess_currency(total_str)
@@ -260,13 +608,43 @@ def _parse_summary_fields(resp: Dict[str, Any]) -> Tuple[Optional[str], Optional
     return vendor, total, currency, date
 
 
-def _pick_summary(summary_fields: List[Dict[str, Any]], keys: List[str]) -> Optional[str]:
-    for want in keys:
-        for f in summary_fields:
-            ftype = ((f.get("Type") or {}).get("Text") or "").strip().upper()
-            if ftype == want:
-                return _field_value_text(f)
-    return None
+def _index_fields(fields: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
+    """
+    One pass over a Textract field list: TYPE (upper) -> value text.
+    First occurrence of a type wins, same as scanning the list in order.
+    """
+    idx: Dict[str, Optional[str]] = {}
+    for f in fields:
+        ftype = ((f.get("Type") or {}).get("Text") or "").strip().upper()
+        if ftype not in idx:
+            idx[ftype] = _field_value_text(f)
+    return idx
+
+
+def _make_picker(keys: Tuple[str, ...]) -> Callable[[Dict[str, Optional[str]]], Optional[str]]:
+    """
+    Builds pick(idx) for a fixed priority tuple as straight-line code, e.g.
+        if "TOTAL" in idx: return idx["TOTAL"]
+        if "AMOUNT_DUE" in idx: return idx["AMOUNT_DUE"]
+        return None
+    so the hot parse path has no per-key Python loop.
+    """
+    lines = ["def pick(idx):"]
+    lines += [f"    if {k!r} in idx: return idx[{k!r}]" for k in keys]
+    lines.append("    return None")
+    ns: Dict[str, Any] = {}
+    exec("\n".join(lines), ns)
+    return ns["pick"]
+
+
+_pick_vendor = _make_picker(VENDOR_KEYS)
+_pick_total = _make_picker(TOTAL_KEYS)
+_pick_date = _make_picker(DATE_KEYS)
+
+_pick_desc = _make_picker(DESC_KEYS)
+_pick_qty = _make_picker(QTY_KEYS)
+_pick_unit_price = _make_picker(UNIT_PRICE_KEYS)
+_pick_amount = _make_picker(AMOUNT_KEYS)
 
 
 def _field_value_text(field: Dict[str, Any]) -> Optional[str]:
@@ -275,11 +653,20 @@ def _field_value_text(field: Dict[str, Any]) -> Optional[str]:
     return txt or None
 
 
+# str.translate table: deletes every ASCII char except 0-9 . - plus the common
+# currency symbols / no-break space. Rarer non-ASCII input falls back to a regex.
+_NUMERIC_DELETE = str.maketrans(
+    "", "", "".join(chr(c) for c in range(128) if chr(c) not in "0123456789.-") + "£€¥₹\u00a0"
+)
+_NON_NUMERIC_RE = re.compile(r"[^0-9\.\-]")
+
+
 def _to_float(val: Optional[str]) -> Optional[float]:
     if not val:
         return None
-    s = val.strip().replace(",", "")
-    s = re.sub(r"[^0-9\.\-]", "", s)
+    s = val.translate(_NUMERIC_DELETE)
+    if not s.isascii():
+        s = _NON_NUMERIC_RE.sub("", s)
     if not s:
         return None
     try:
@@ -300,7 +687,7 @@ def _guess_currency(val: Optional[str]) -> Optional[str]:
     return None
 
 
-def _parse_line_items(resp: Dict[str, Any]) -> List[Dict[str, Any]]:
+def _parse_line_items(resp: Dict[str, Any], with_raw_fields: bool = False) -> List[Dict[str, Any]]:
     docs = resp.get("ExpenseDocuments") or []
     if not docs:
         return []
@@ -312,47 +699,49 @@ def _parse_line_items(resp: Dict[str, Any]) -> List[Dict[str, Any]]:
     for g in groups:
         line_items = g.get("LineItems") or []
         for li in line_items:
-            fields = li.get("LineItemExpenseFields") or []
-            description = _pick_line_item(fields, ["ITEM", "DESCRIPTION", "PRODUCT_CODE", "NAME"])
-            quantity = _to_float(_pick_line_item(fields, ["QUANTITY"]))
-            unit_price = _to_float(_pick_line_item(fields, ["UNIT_PRICE", "PRICE"]))
-            amount = _to_float(_pick_line_item(fields, ["AMOUNT", "LINE_TOTAL", "TOTAL_PRICE"]))
+            idx, raw_fields = _index_line_item_fields(li.get("LineItemExpenseFields") or [], with_raw_fields)
+            description = _pick_desc(idx)
+            quantity = _to_float(_pick_qty(idx))
+            unit_price = _to_float(_pick_unit_price(idx))
+            amount = _to_float(_pick_amount(idx))
 
             if amount is None and quantity is not None and unit_price is not None:
                 amount = round(quantity * unit_price, 2)
 
-            items_out.append(
-                {
-                    "description": description,
-                    "quantity": quantity,
-                    "unit_price": unit_price,
-                    "amount": amount,
-                    "raw_fields": _flatten_fields(fields),
-                }
-            )
+            # Skip empty rows
+            if not (description or amount is not None or unit_price is not None):
+                continue
 
-    cleaned = [
-        x
-        for x in items_out
-        if (x.get("description") or x.get("amount") is not None or x.get("unit_price") is not None)
-    ]
-    return cleaned
+            item: Dict[str, Any] = {
+                "description": description,
+                "quantity": quantity,
+                "unit_price": unit_price,
+                "amount": amount,
+            }
+            if raw_fields is not None:
+                item["raw_fields"] = raw_fields
+            items_out.append(item)
 
-
-def _pick_line_item(fields: List[Dict[str, Any]], keys: List[str]) -> Optional[str]:
-    for want in keys:
-        for f in fields:
-            ftype = ((f.get("Type") or {}).get("Text") or "").strip().upper()
-            if ftype == want:
-                return _field_value_text(f)
-    return None
+    return items_out
 
 
-def _flatten_fields(fields: List[Dict[str, Any]]) -> Dict[str, Optional[str]]:
-    out: Dict[str, Optional[str]] = {}
+def _index_line_item_fields(
+    fields: List[Dict[str, Any]],
+    with_raw: bool = False,
+) -> Tuple[Dict[str, Optional[str]], Optional[Dict[str, Optional[str]]]]:
+    """
+    Single pass over a line item's fields.
+    Returns: idx (TYPE upper -> text, first wins),
+             raw_fields (Type as sent -> text, last wins) or None unless with_raw
+    """
+    idx: Dict[str, Optional[str]] = {}
+    raw: Optional[Dict[str, Optional[str]]] = {} if with_raw else None
     for f in fields:
         k = ((f.get("Type") or {}).get("Text") or "").strip()
         if not k:
             continue
-        out[k] = _field_value_text(f)
-    return out
+        txt = _field_value_text(f)
+        if raw is not None:
+            raw[k] = txt
+        idx.setdefault(k.upper(), txt)
+    return idx, raw